@@ -18,7 +18,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import time
+from multiprocessing.pool import ThreadPool
 
 import portpicker
 import tensorflow as tf
@@ -45,28 +45,50 @@ def create_local_cluster(num_workers, num_ps, protocol="grpc"):
   return workers, ps_servers
 
 
-# Creates the workers and return their sessions, graphs, train_ops.
-def get_workers(num_workers, replicas_to_aggregate, workers):
-  sessions = []
-  graphs = []
-  train_ops = []
-  for worker_id in range(num_workers):
+# Creates the workers and return their sessions, handles, train_ops. The
+# handles map names to the variables and tensors the tests check. The chief
+# queue runner threads are registered with coord.
+def get_workers(num_workers, replicas_to_aggregate, workers, coord):
+  def _start_chief(session, sync_init_op, chief_queue_runner):
+    session.run(sync_init_op)
+    chief_queue_runner.create_threads(session, coord=coord, daemon=True,
+                                      start=True)
+
+  def _create_worker(worker_id):
+    # Every worker builds its own graph, like separate worker processes would.
+    # Each worker's session registers its partitions with its own master, so
+    # a shared graph would not save any RegisterGraph calls.
     graph = tf.Graph()
     is_chief = (worker_id == 0)
     with graph.as_default():
       with tf.device("/job:ps/task:0"):
         global_step = tf.Variable(0, name="global_step", trainable=False)
         var_0 = tf.Variable(0.0, name="v0")
+        # The chief enqueues the new global step here after every update so
+        # that the tests can block on it instead of polling the global step.
+        # The queue is unbounded: the enqueue runs in the chief queue runner,
+        # so a full queue would stop the chief from releasing new tokens.
+        global_step_queue = tf.FIFOQueue(-1,
+                                         global_step.dtype.base_dtype,
+                                         shapes=(),
+                                         shared_name="global_step_q")
+        global_step_watcher = global_step_queue.dequeue()
       with tf.device("/job:ps/task:1"):
         var_1 = tf.Variable(1.0, name="v1")
         var_sparse = tf.Variable([[3.0], [4.0]], name="v_sparse")
 
       with tf.device("/job:worker/task:"+str(worker_id)):
-        grads_0 = tf.constant(0.1+worker_id*0.2)
-        grads_1 = tf.constant(0.9+worker_id*0.2)
-        # This is to test against sparse gradients.
+        # The gradients default to per worker constants but can be fed.
+        grads_0 = tf.placeholder_with_default(
+            tf.constant(0.1+worker_id*0.2), shape=[])
+        grads_1 = tf.placeholder_with_default(
+            tf.constant(0.9+worker_id*0.2), shape=[])
+        # This is to test against sparse gradients. It is aggregated by a
+        # SparseConditionalAccumulator, so keep it as IndexedSlices even though
+        # a dense gradient of var_sparse would be as small.
         grads_sparse = tf.IndexedSlices(
-            tf.constant([0.1+worker_id*0.2], shape=[1, 1]),
+            tf.placeholder_with_default(
+                tf.constant([0.1+worker_id*0.2], shape=[1, 1]), shape=[1, 1]),
             tf.constant([1]),
             tf.constant([2, 1]))
         sgd_opt = tf.train.GradientDescentOptimizer(2.0)
@@ -77,76 +99,167 @@ def get_workers(num_workers, replicas_to_aggregate, workers):
             zip([grads_0, grads_1, grads_sparse], [var_0, var_1, var_sparse]),
             global_step=global_step)]
 
-        init_op = tf.global_variables_initializer()
         # Needed ops from the sync_rep optimizer. This is mainly for the
         # local_step initialization.
         local_init_op = sync_rep_opt.local_step_init_op
+        ready_for_local_init_op = sync_rep_opt.ready_for_local_init_op
+        ready_op = tf.report_uninitialized_variables()
+
+        # Only the chief initializes the variables, fills the token queue and
+        # runs the chief queue runner, so the other workers do not build these
+        # ops. They wait for the chief in wait_for_session().
+        init_op = None
+        sync_init_op = None
+        chief_queue_runner = None
         if is_chief:
+          init_op = tf.global_variables_initializer()
           local_init_op = sync_rep_opt.chief_init_op
-        ready_for_local_init_op = sync_rep_opt.ready_for_local_init_op
-
-        # Chief_queue_runner
-        chief_queue_runner = sync_rep_opt.get_chief_queue_runner()
-        sync_init_op = sync_rep_opt.get_init_tokens_op(num_workers)
-
-    # Creates session for chief.
-    supervisor = tf.train.Supervisor(
-        graph=graph,
-        is_chief=is_chief,
-        recovery_wait_secs=1,
-        init_op=init_op,
+          sync_init_op = sync_rep_opt.get_init_tokens_op(num_workers)
+          chief_queue_runner = sync_rep_opt.get_chief_queue_runner()
+          with tf.device("/job:ps/task:0"):
+            with tf.control_dependencies(chief_queue_runner.enqueue_ops):
+              notify_op = global_step_queue.enqueue(global_step.ref())
+          chief_queue_runner = tf.train.QueueRunner(chief_queue_runner.queue,
+                                                    [notify_op])
+
+    graph.finalize()
+
+    # Creates the session directly with a SessionManager: the workers need no
+    # saver, summaries or other Supervisor services.
+    session_manager = tf.train.SessionManager(
         local_init_op=local_init_op,
-        ready_for_local_init_op=ready_for_local_init_op)
-    session = supervisor.prepare_or_wait_for_session(workers[worker_id].target)
+        ready_op=ready_op,
+        ready_for_local_init_op=ready_for_local_init_op,
+        graph=graph,
+        recovery_wait_secs=1)
+    if is_chief:
+      session = session_manager.prepare_session(workers[worker_id].target,
+                                                init_op=init_op)
+    else:
+      session = session_manager.wait_for_session(workers[worker_id].target)
 
     # Chief should execute the sync_init_op and start the chief queue runner.
+    # This runs in the background while the other workers are being created.
     if is_chief:
-      session.run(sync_init_op)
-      supervisor.StartQueueRunners(session, [chief_queue_runner])
-
-    sessions.append(session)
-    graphs.append(graph)
-    train_ops.append(train_op)
-
-  return sessions, graphs, train_ops
+      chief_startup.append(pool.apply_async(
+          _start_chief,
+          (session, sync_init_op, chief_queue_runner)))
+
+    handles = {
+        "var_0": var_0,
+        "var_1": var_1,
+        "var_sparse": var_sparse,
+        "global_step": global_step,
+        "local_step": graph.get_tensor_by_name("sync_rep_local_step:0"),
+        "global_step_watcher": global_step_watcher,
+    }
+    return session, handles, train_op
+
+  # The chief has to start first as it initializes the variables. The other
+  # workers only wait for the chief, so they are created concurrently with
+  # each other and with the rest of the chief startup.
+  pool = ThreadPool(num_workers)
+  chief_startup = []
+  try:
+    created = [_create_worker(0)]
+    created.extend(pool.map(_create_worker, range(1, num_workers)))
+    chief_startup[0].get()
+  finally:
+    pool.close()
+    pool.join()
+
+  sessions, handles, train_ops = [list(x) for x in zip(*created)]
+  return sessions, handles, train_ops
 
 
 class SyncReplicasOptimizerV2Test(tf.test.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    # The servers are shared by all the tests. Each test only uses the first
+    # num_workers workers of the cluster.
+    cls._workers, cls._ps_servers = create_local_cluster(num_workers=3,
+                                                         num_ps=2)
+
+  def setUp(self):
+    super(SyncReplicasOptimizerV2Test, self).setUp()
+    # Clears the variables, queues and accumulators left on the cluster by the
+    # previous test.
+    tf.Session.reset(self._workers[0].target)
+    self._coord = tf.train.Coordinator()
+    self._sessions = []
+
+  def tearDown(self):
+    # Requests the stop first: closing the chief session cancels the sync step
+    # its queue runner is blocked in, and that error is then ignored by the
+    # coordinator instead of being re-raised by join().
+    self._coord.request_stop()
+    for session in self._sessions:
+      session.close()
+    self._coord.join(stop_grace_period_secs=10)
+    super(SyncReplicasOptimizerV2Test, self).tearDown()
+
+  def _get_workers(self, num_workers, replicas_to_aggregate):
+    sessions, handles, train_ops = get_workers(num_workers,
+                                               replicas_to_aggregate,
+                                               self._workers, self._coord)
+    self._sessions.extend(sessions)
+    return sessions, handles, train_ops
+
   def _run(self, train_op, sess):
     sess.run(train_op)
 
+  def _run_concurrently(self, train_ops, sessions):
+    # Runs every train_op in its own session at the same time and returns once
+    # all of them are done. Errors are re-raised in the calling thread.
+    pool = ThreadPool(len(sessions))
+    try:
+      pool.map(lambda args: self._run(*args), zip(train_ops, sessions))
+    finally:
+      pool.close()
+      pool.join()
+
+  def _wait_for_global_step(self, sess, global_step_watcher, step):
+    # The chief notifies every new global step once, so skip the older
+    # notifications until the expected step shows up.
+    run_options = tf.RunOptions(timeout_in_ms=60000)
+    current_step = -1
+    while current_step < step:
+      current_step = sess.run(global_step_watcher, options=run_options)
+    self.assertAllEqual(step, current_step)
+
   def test2Workers(self):
     num_workers = 2
     replicas_to_aggregate = 2
-    num_ps = 2
-    workers, _ = create_local_cluster(num_workers=num_workers, num_ps=num_ps)
 
     # Creates and returns all the workers.
-    sessions, graphs, train_ops = get_workers(num_workers,
-                                              replicas_to_aggregate,
-                                              workers)
+    sessions, handles, train_ops = self._get_workers(num_workers,
+                                                     replicas_to_aggregate)
 
     # Chief should have already initialized all the variables.
-    var_0_g_0 = graphs[0].get_tensor_by_name("v0:0")
-    var_1_g_0 = graphs[0].get_tensor_by_name("v1:0")
-    local_step_0 = graphs[0].get_tensor_by_name("sync_rep_local_step:0")
-    self.assertAllEqual(0.0, var_0_g_0.eval(session=sessions[0]))
-    self.assertAllEqual(1.0, var_1_g_0.eval(session=sessions[0]))
-    self.assertAllEqual(0, local_step_0.eval(session=sessions[0]))
+    var_0_g_0 = handles[0]["var_0"]
+    var_1_g_0 = handles[0]["var_1"]
+    local_step_0 = handles[0]["local_step"]
+    var_0, var_1, local_step = sessions[0].run(
+        [var_0_g_0, var_1_g_0, local_step_0])
+    self.assertAllEqual(0.0, var_0)
+    self.assertAllEqual(1.0, var_1)
+    self.assertAllEqual(0, local_step)
 
     # Will just use session 1 to verify all the variables later.
-    var_0_g_1 = graphs[1].get_tensor_by_name("v0:0")
-    var_1_g_1 = graphs[1].get_tensor_by_name("v1:0")
-    var_sparse_g_1 = graphs[1].get_tensor_by_name("v_sparse:0")
-    local_step_1 = graphs[1].get_tensor_by_name("sync_rep_local_step:0")
-    global_step = graphs[1].get_tensor_by_name("global_step:0")
+    var_0_g_1 = handles[1]["var_0"]
+    var_1_g_1 = handles[1]["var_1"]
+    var_sparse_g_1 = handles[1]["var_sparse"]
+    local_step_1 = handles[1]["local_step"]
+    global_step = handles[1]["global_step"]
+    global_step_watcher = handles[1]["global_step_watcher"]
 
     # The steps should also be initialized.
-    self.assertAllEqual(0, global_step.eval(session=sessions[1]))
-    self.assertAllEqual(0, local_step_1.eval(session=sessions[1]))
-    self.assertAllClose([[3.0], [4.0]],
-                        var_sparse_g_1.eval(session=sessions[1]))
+    step, local_step, var_sparse = sessions[1].run(
+        [global_step, local_step_1, var_sparse_g_1])
+    self.assertAllEqual(0, step)
+    self.assertAllEqual(0, local_step)
+    self.assertAllClose([[3.0], [4.0]], var_sparse)
 
     # We have initial tokens in the queue so we can call this one by one. After
     # the first step, this will no longer work as there will be no more extra
@@ -156,13 +269,13 @@ class SyncReplicasOptimizerV2Test(tf.test.TestCase):
 
     # The global step should have been updated and the variables should now have
     # the new values after the average of the gradients are applied.
-    while global_step.eval(session=sessions[1]) != 1:
-      time.sleep(0.01)
+    self._wait_for_global_step(sessions[1], global_step_watcher, 1)
 
-    self.assertAllClose(0-(0.1+0.3)/2*2.0, var_0_g_1.eval(session=sessions[1]))
-    self.assertAllClose(1-(0.9+1.1)/2*2.0, var_1_g_1.eval(session=sessions[1]))
-    self.assertAllClose([[3.0], [4.0-(0.1+0.3)/2*2.0]],
-                        var_sparse_g_1.eval(session=sessions[1]))
+    var_0, var_1, var_sparse, local_step = sessions[1].run(
+        [var_0_g_1, var_1_g_1, var_sparse_g_1, local_step_1])
+    self.assertAllClose(0-(0.1+0.3)/2*2.0, var_0)
+    self.assertAllClose(1-(0.9+1.1)/2*2.0, var_1)
+    self.assertAllClose([[3.0], [4.0-(0.1+0.3)/2*2.0]], var_sparse)
 
     # The local step for both workers should still be 0 because the initial
     # tokens in the token queue are 0s. This means that the following
@@ -170,62 +283,52 @@ class SyncReplicasOptimizerV2Test(tf.test.TestCase):
     # the current global step. However, this only happens once when the system
     # just starts and this is necessary to make the system robust for the case
     # when chief gets restarted by errors/preemption/...
-    self.assertAllEqual(0, local_step_0.eval(session=sessions[0]))
-    self.assertAllEqual(0, local_step_1.eval(session=sessions[1]))
+    self.assertAllEqual(0, sessions[0].run(local_step_0))
+    self.assertAllEqual(0, local_step)
 
     sessions[0].run(train_ops[0])
     sessions[1].run(train_ops[1])
     # Although the global step should still be 1 as explained above, the local
     # step should now be updated to 1. The variables are still the same.
-    self.assertAllEqual(1, global_step.eval(session=sessions[1]))
-    self.assertAllEqual(1, local_step_0.eval(session=sessions[0]))
-    self.assertAllEqual(1, local_step_1.eval(session=sessions[1]))
-    self.assertAllClose(0-(0.1+0.3)/2*2.0, var_0_g_1.eval(session=sessions[1]))
-    self.assertAllClose(1-(0.9+1.1)/2*2.0, var_1_g_1.eval(session=sessions[1]))
+    step, local_step, var_0, var_1 = sessions[1].run(
+        [global_step, local_step_1, var_0_g_1, var_1_g_1])
+    self.assertAllEqual(1, step)
+    self.assertAllEqual(1, sessions[0].run(local_step_0))
+    self.assertAllEqual(1, local_step)
+    self.assertAllClose(0-(0.1+0.3)/2*2.0, var_0)
+    self.assertAllClose(1-(0.9+1.1)/2*2.0, var_1)
 
     # At this step, the token queue is empty. So the 2 workers need to work
     # together to proceed.
-    threads = []
-    threads.append(self.checkedThread(target=self._run,
-                                      args=(train_ops[0], sessions[0])))
-    threads.append(self.checkedThread(target=self._run,
-                                      args=(train_ops[1], sessions[1])))
-
-    # The two workers starts to execute the train op.
-    for thread in threads:
-      thread.start()
-    for thread in threads:
-      thread.join()
+    self._run_concurrently(train_ops, sessions)
 
     # The global step should now be 2 and the gradients should have been
     # applied twice.
-    self.assertAllEqual(2, global_step.eval(session=sessions[1]))
-    self.assertAllClose(0 - 2 * (0.1 + 0.3) / 2 * 2.0,
-                        var_0_g_1.eval(session=sessions[1]))
-    self.assertAllClose(1 - 2 * (0.9 + 1.1) / 2 * 2.0,
-                        var_1_g_1.eval(session=sessions[1]))
+    step, var_0, var_1 = sessions[1].run([global_step, var_0_g_1, var_1_g_1])
+    self.assertAllEqual(2, step)
+    self.assertAllClose(0 - 2 * (0.1 + 0.3) / 2 * 2.0, var_0)
+    self.assertAllClose(1 - 2 * (0.9 + 1.1) / 2 * 2.0, var_1)
 
   # 3 workers and one of them is backup.
   def test3Workers1Backup(self):
     num_workers = 3
     replicas_to_aggregate = 2
-    num_ps = 2
-    workers, _ = create_local_cluster(num_workers=num_workers, num_ps=num_ps)
 
     # Creates and returns all the workers.
-    sessions, graphs, train_ops = get_workers(num_workers,
-                                              replicas_to_aggregate,
-                                              workers)
+    sessions, handles, train_ops = self._get_workers(num_workers,
+                                                     replicas_to_aggregate)
 
     # Chief should have already initialized all the variables.
-    var_0_g_1 = graphs[1].get_tensor_by_name("v0:0")
-    var_1_g_1 = graphs[1].get_tensor_by_name("v1:0")
-    local_step_1 = graphs[1].get_tensor_by_name("sync_rep_local_step:0")
-    global_step = graphs[1].get_tensor_by_name("global_step:0")
+    var_0_g_1 = handles[1]["var_0"]
+    var_1_g_1 = handles[1]["var_1"]
+    local_step_1 = handles[1]["local_step"]
+    global_step = handles[1]["global_step"]
+    global_step_watcher = handles[1]["global_step_watcher"]
 
     # The steps should also be initilized.
-    self.assertAllEqual(0, global_step.eval(session=sessions[1]))
-    self.assertAllEqual(0, local_step_1.eval(session=sessions[1]))
+    step, local_step = sessions[1].run([global_step, local_step_1])
+    self.assertAllEqual(0, step)
+    self.assertAllEqual(0, local_step)
 
     # We have initial tokens in the queue so we can call this one by one. After
     # the token queue becomes empty, they should be called concurrently.
@@ -236,12 +339,12 @@ class SyncReplicasOptimizerV2Test(tf.test.TestCase):
     # The global step should have been updated since we only need to collect 2
     # gradients. The variables should now have the new values after the average
     # of the gradients from worker 0/2 are applied.
-    while global_step.eval(session=sessions[1]) != 1:
-      time.sleep(0.01)
+    self._wait_for_global_step(sessions[1], global_step_watcher, 1)
 
-    self.assertAllEqual(1, global_step.eval(session=sessions[1]))
-    self.assertAllClose(0-(0.1+0.5)/2*2.0, var_0_g_1.eval(session=sessions[1]))
-    self.assertAllClose(1-(0.9+1.3)/2*2.0, var_1_g_1.eval(session=sessions[1]))
+    step, var_0, var_1 = sessions[1].run([global_step, var_0_g_1, var_1_g_1])
+    self.assertAllEqual(1, step)
+    self.assertAllClose(0-(0.1+0.5)/2*2.0, var_0)
+    self.assertAllClose(1-(0.9+1.3)/2*2.0, var_1)
 
     # Worker 1 finished later and its gradients will now be dropped as it is
     # stale.
@@ -255,8 +358,9 @@ class SyncReplicasOptimizerV2Test(tf.test.TestCase):
 
     # Although the global step should still be 1 as explained above, the local
     # step should now be updated to 1. Just check worker 1 as an example.
-    self.assertAllEqual(1, global_step.eval(session=sessions[1]))
-    self.assertAllEqual(1, local_step_1.eval(session=sessions[1]))
+    step, local_step = sessions[1].run([global_step, local_step_1])
+    self.assertAllEqual(1, step)
+    self.assertAllEqual(1, local_step)
 
     thread_0 = self.checkedThread(target=self._run,
                                   args=(train_ops[0], sessions[0]))
@@ -267,19 +371,46 @@ class SyncReplicasOptimizerV2Test(tf.test.TestCase):
     # It will wait as we need 2 workers to finish this step and the global step
     # should be still 1.
     thread_0.start()
-    self.assertAllEqual(1, global_step.eval(session=sessions[1]))
+    self.assertAllEqual(1, sessions[1].run(global_step))
 
     # Starts worker 1.
     thread_1.start()
     thread_1.join()
+    thread_0.join()
 
     # The global step should now be 2 and the gradients should have been
     # applied again.
-    self.assertAllEqual(2, global_step.eval(session=sessions[1]))
-    self.assertAllClose(-0.6 -(0.1 + 0.3) / 2 * 2.0,
-                        var_0_g_1.eval(session=sessions[1]))
-    self.assertAllClose(-1.2 - (0.9 + 1.1) / 2 * 2.0,
-                        var_1_g_1.eval(session=sessions[1]))
+    step, var_0, var_1 = sessions[1].run([global_step, var_0_g_1, var_1_g_1])
+    self.assertAllEqual(2, step)
+    self.assertAllClose(-0.6 -(0.1 + 0.3) / 2 * 2.0, var_0)
+    self.assertAllClose(-1.2 - (0.9 + 1.1) / 2 * 2.0, var_1)
+
+
+# Only builds graphs, so it does not need the local cluster.
+class SyncReplicasOptimizerV2PlacementTest(tf.test.TestCase):
+
+  def testSyncOpsColocatedWithGlobalStep(self):
+    # The token queue is pinned next to the global step, while the local step
+    # has to stay on its worker since every replica keeps its own.
+    with tf.Graph().as_default() as graph:
+      with tf.device("/job:ps/task:0"):
+        global_step = tf.Variable(0, name="global_step", trainable=False)
+      with tf.device("/job:ps/task:1"):
+        var = tf.Variable(1.0, name="v")
+      with tf.device("/job:worker/task:0"):
+        sgd_opt = tf.train.GradientDescentOptimizer(2.0)
+        sync_rep_opt = tf.train.SyncReplicasOptimizerV2(
+            sgd_opt, replicas_to_aggregate=2, total_num_replicas=2)
+        sync_rep_opt.apply_gradients([(tf.constant(0.1), var)],
+                                     global_step=global_step)
+        sync_init_op = sync_rep_opt.get_init_tokens_op()
+
+    for op in sync_rep_opt.get_chief_queue_runner().enqueue_ops + [
+        sync_init_op]:
+      self.assertEqual(global_step.device, op.device)
+    local_step = graph.get_tensor_by_name("sync_rep_local_step:0")
+    self.assertEqual("/job:worker/task:0", local_step.device)
+
 
 if __name__ == "__main__":
   tf.test.main()